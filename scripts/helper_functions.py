@@ -61,15 +61,34 @@ class RandomSampler:
 
         self.noise_range = noise_range
 
-    def sample(self, value: float) -> float:
-        if self.noisy and rng.random() < self.noise:
-            return rng.uniform(*self.noise_range)
-        else:
-            return rng.normal(value, self.stddev)
+    def sample(self, value: Union[float, np.array], size: Optional[int] = None,
+               standard_normals: Optional[np.array] = None) -> Union[float, np.array]:
+        """
+        Sample around value, which may be a float or an array (each element is sampled independently).
+        Pass size to draw that many samples around a single value at once.
+
+        Pre-drawn standard normal samples (one per sample) can be passed as standard_normals, which
+        lets the caller draw the noise for several samplers with a single rng call.
+        """
+        if standard_normals is None:
+            standard_normals = rng.standard_normal(
+                np.shape(value) if size is None else size)
+
+        samples = value + (self.stddev * standard_normals)
+
+        if self.noisy:
+            is_noise = rng.random(np.shape(samples)) < self.noise
+            samples = np.where(
+                is_noise,
+                rng.uniform(*self.noise_range, np.shape(samples)),
+                samples
+            )
+
+        return samples
 
     @property
     def noisy(self):
-        self.noise != 0.0
+        return self.noise != 0.0
 
 
 class RelativeRandomSampler:
@@ -87,25 +106,43 @@ class RelativeRandomSampler:
 
         self.noise_range = noise_range
 
-    def sample(self, value: float) -> float:
-        if self.noisy and rng.random() < self.noise:
-            return rng.uniform(self.noise_range[0] * value, self.noise_range[1] * value)
-        else:
-            sign = signum(value)
-            value_abs = abs(value)
-            return sign * rng.normal(value_abs, self.stddev * value_abs)
+    def sample(self, value: Union[float, np.array], size: Optional[int] = None) -> Union[float, np.array]:
+        """ See RandomSampler.sample. """
+        sign = np.sign(value)
+        value_abs = np.abs(value)
+        samples = sign * rng.normal(value_abs, self.stddev * value_abs, size)
+
+        if self.noisy:
+            is_noise = rng.random(np.shape(samples)) < self.noise
+            samples = np.where(
+                is_noise,
+                rng.uniform(self.noise_range[0] * value, self.noise_range[1] * value,
+                            np.shape(samples)),
+                samples
+            )
+
+        return samples
 
     @property
     def noisy(self):
-        self.noise != 0.0
+        return self.noise != 0.0
+
 
+def systematic_resample(weights: np.array, k: int) -> np.array:
+    """
+    Draw k indices into weights using systematic (low-variance) resampling.
 
-def rotation_matrix(angle: float) -> np.array:
-    """ Generate a rotation matrix. """
-    return np.array([
-        [np.cos(angle), -np.sin(angle)],
-        [np.sin(angle), np.cos(angle)]
-    ])
+    A single uniform offset is drawn, and then k evenly-spaced points are looked up in the
+    cumulative distribution of the weights. Weights don't need to be normalized.
+    """
+    cumulative_weights = np.cumsum(weights)
+    cumulative_weights /= cumulative_weights[-1]
+    positions = (np.arange(k) + rng.random()) / k
+    # Guard against floating point error at the very end of the distribution
+    return np.minimum(
+        np.searchsorted(cumulative_weights, positions),
+        len(weights) - 1
+    )
 
 
 def make_marker(point: Union[Point, Iterable[Point]] = Point(0, 0, 0),
@@ -165,17 +202,6 @@ def print_time(name: str = "Timer"):
     print(f"{name} took {duration * 1000:.2f}ms.\n")
 
 
-def signum(a: float) -> float:
-    """ Return the sign of a number (ie. -1, 1, or 0). """
-
-    if a > 0.0:
-        return 1.0
-    elif a < 0.0:
-        return -1.0
-    else:
-        return 0.0
-
-
 class TFHelper(object):
     """ TFHelper Provides functionality to convert poses between various
         forms, compare angles in a suitable way, and publish needed
@@ -220,12 +246,13 @@ class TFHelper(object):
 
     def convert_pose_to_xy_and_theta(self, pose):
         """ Convert pose (geometry_msgs.Pose) to a (x,y,yaw) tuple """
-        orientation_tuple = (pose.orientation.x,
-                             pose.orientation.y,
-                             pose.orientation.z,
-                             pose.orientation.w)
-        angles = t.euler_from_quaternion(orientation_tuple)
-        return (pose.position.x, pose.position.y, angles[2])
+        # This is called on every odometry message, so compute the yaw directly instead of using
+        # euler_from_quaternion (which builds a full rotation matrix to get all three angles)
+        # Both arguments scale with the quaternion's squared norm, so it doesn't need to be normalized
+        q = pose.orientation
+        yaw = math.atan2(2.0 * ((q.w * q.z) + (q.x * q.y)),
+                         (q.w * q.w) + (q.x * q.x) - (q.y * q.y) - (q.z * q.z))
+        return (pose.position.x, pose.position.y, yaw)
 
     def angle_normalize(self, z):
         """ convenience function to map an angle to the range [-pi,pi] """
@@ -1,7 +1,7 @@
 import numpy as np
 
-from typing import List
-from helper_functions import PoseTuple, Particle, rotation_matrix, RelativeRandomSampler
+from typing import Tuple
+from helper_functions import PoseTuple, RelativeRandomSampler
 
 
 class MotionModel:
@@ -13,17 +13,25 @@ class MotionModel:
     def __init__(self, stddev: float):
         self.error_sampler = RelativeRandomSampler(stddev)
 
-    def apply(self, particle: Particle, delta_pose: PoseTuple) -> Particle:
-        dx_robot = self.error_sampler.sample(delta_pose.x)
-        dy_robot = self.error_sampler.sample(delta_pose.y)
-        dtheta = self.error_sampler.sample(delta_pose.theta)
+    def apply(self, xs: np.array, ys: np.array, thetas: np.array,
+              delta_pose: PoseTuple) -> Tuple[np.array, np.array, np.array]:
+        """
+        Apply the motion model to every particle at once. Returns the new x, y, and theta arrays.
+        """
+        num_particles = len(xs)
+        dx_robot = self.error_sampler.sample(delta_pose.x, num_particles)
+        dy_robot = self.error_sampler.sample(delta_pose.y, num_particles)
+        dtheta = self.error_sampler.sample(delta_pose.theta, num_particles)
 
-        dx, dy = np.matmul(rotation_matrix(
-            particle.theta), [dx_robot, dy_robot])
+        # Rotate from the robot's frame into the map frame (by each particle's heading)
+        coses = np.cos(thetas)
+        sines = np.sin(thetas)
+        dx = (coses * dx_robot) - (sines * dy_robot)
+        dy = (sines * dx_robot) + (coses * dy_robot)
 
-        return Particle(
-            x=particle.x - dx,
-            y=particle.y - dy,
-            theta=particle.theta - dtheta,
-            weight=particle.weight
+        # Keep the particles' dtype (the noise is always float64)
+        return (
+            (xs - dx).astype(xs.dtype, copy=False),
+            (ys - dy).astype(ys.dtype, copy=False),
+            (thetas - dtheta).astype(thetas.dtype, copy=False)
         )
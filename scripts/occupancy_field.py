@@ -0,0 +1,53 @@
+import numpy as np
+
+from typing import Union
+from scipy.ndimage import distance_transform_edt
+
+from nav_msgs.msg import OccupancyGrid
+
+
+class OccupancyField:
+    """
+    Precomputes the distance from every cell of a map to the closest obstacle, so that looking up
+    the distance to the closest obstacle from any point is O(1).
+
+    All points are in the `map` frame.
+    """
+
+    map: OccupancyGrid
+
+    closest_obstacle_distances: np.array
+    """ (height, width)-sized grid of the distance (in meters) from each cell to the closest obstacle. """
+
+    def __init__(self, map: OccupancyGrid):
+        if map.info.origin.orientation.w != 1.0:
+            raise ValueError("Unsupported map with rotated origin.")
+
+        self.map = map
+
+        # Occupancy grids are stored in row major order, so each row of the grid is one y value
+        grid = np.asarray(map.data, dtype=np.int8).reshape(
+            (map.info.height, map.info.width))
+
+        # distance_transform_edt finds the distance to the closest zero, so make obstacles zero.
+        # Unknown cells (-1) are treated as free.
+        self.closest_obstacle_distances = (
+            distance_transform_edt(grid <= 0) * map.info.resolution
+        ).astype(np.float32)
+
+    def get_closest_obstacle_distance(self, x: Union[float, np.array], y: Union[float, np.array]) -> np.array:
+        """
+        Find the distance from each point (x[i], y[i]) to the closest obstacle. x and y can be
+        arrays of any (matching) shape, and an array of that shape is returned.
+
+        Points outside the map return NaN.
+        """
+        info = self.map.info
+        xs = np.round((np.asarray(x) - info.origin.position.x) / info.resolution).astype(np.intp)
+        ys = np.round((np.asarray(y) - info.origin.position.y) / info.resolution).astype(np.intp)
+
+        in_map = (xs >= 0) & (xs < info.width) & (ys >= 0) & (ys < info.height)
+
+        distances = np.full(xs.shape, np.nan, dtype=np.float32)
+        distances[in_map] = self.closest_obstacle_distances[ys[in_map], xs[in_map]]
+        return distances
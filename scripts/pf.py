@@ -1,28 +1,32 @@
 #!/usr/bin/env python3
 
 import math
+import queue
 import rospy
-import random
+import threading
+import traceback
 
 import numpy as np
-from typing import List, Optional
+from typing import Optional, Tuple, Type
+from scipy.special import logsumexp
 
 import tf2_ros
 import tf2_geometry_msgs  # Importing for side-effects
-from nav_msgs.msg import Odometry
+from nav_msgs.msg import Odometry, OccupancyGrid
 from nav_msgs.srv import GetMap
 from sensor_msgs.msg import LaserScan
 from visualization_msgs.msg import Marker, MarkerArray
-from geometry_msgs.msg import PoseWithCovarianceStamped
+from geometry_msgs.msg import Pose, PoseWithCovarianceStamped
 
-from sensor_model import ParallelRayTracingSensorModel, SensorModel, RayTracingSensorModel
+from sensor_model import ParallelRayTracingSensorModel, SensorModel, LikelihoodFieldSensorModel
 from motion_model import MotionModel
 
-from helper_functions import TFHelper,  PoseTuple, Particle, RandomSampler, make_marker, print_time
+from helper_functions import TFHelper,  PoseTuple, Particle, RandomSampler, make_marker, systematic_resample, normalize_angle, print_time, rng
 
 
 class ParticleFilter:
-    USE_MULTIPROCESS_SENSOR_MODEL = True
+    # Any SensorModel works here (LikelihoodFieldSensorModel, NumbaRayTracingSensorModel, ...)
+    SENSOR_MODEL_CLASS: Type[SensorModel] = LikelihoodFieldSensorModel
     DEBUG_SAVE_SENSOR_STATE_PLOTS = 0
 
     NUM_PARTICLES = 200
@@ -33,6 +37,40 @@ class ParticleFilter:
     motion_model = MotionModel(stddev=.05)
     sensor_model: SensorModel
 
+    # Augmented MCL: if the average particle weight drops suddenly (ie. the short-term average falls
+    # below the long-term average), replace some particles with new ones sampled around recent pose
+    # estimates or anywhere on the map, so the filter can recover instead of wasting updates on
+    # hopeless particles.
+    RECOVERY_ALPHA_SLOW: float = 0.001
+    RECOVERY_ALPHA_FAST: float = 0.1
+    RECENT_POSES_SIZE: int = 50
+    RECOVERY_MAP_FRACTION: float = 0.5
+    """
+    Fraction of recovery particles sampled uniformly from the map's free space (the rest are sampled
+    around recent pose estimates). After a kidnapping, the recent pose estimates are wrong too, so
+    these are the only recovery particles that can find the robot again.
+    """
+
+    recovery_sampler_xy = RandomSampler(0.5, 0)
+    recovery_sampler_theta = RandomSampler(0.5 * math.pi, 0)
+
+    weight_avg_slow: float = 0.0
+    weight_avg_fast: float = 0.0
+    """
+    Long- and short-term exponential moving averages of the average (unnormalized) particle weight,
+    per LIDAR reading used (see update_weight_averages).
+    """
+
+    recent_poses: np.array = None
+    """ (3, RECENT_POSES_SIZE)-sized ring buffer of recent robot pose estimates (x, y, and theta rows). """
+    recent_poses_count: int = 0
+    """ Total number of poses ever recorded in recent_poses (mod RECENT_POSES_SIZE is the next index). """
+
+    free_space: np.array = None
+    """ (2, n)-sized matrix of the x, y coordinates of the center of every free cell on the map. """
+    free_space_resolution: float = 0.0
+    """ Size (in meters) of each free cell in free_space. """
+
     # Don't update unless we've moved a bit
     # Currently set to 0 because more updates imperically seems to lead to more precision
     UPDATE_MIN_DISTANCE: float = 0
@@ -41,16 +79,34 @@ class ParticleFilter:
     last_pose: PoseTuple = None
     last_lidar: Optional[np.array] = None
 
-    particles: List[Particle] = None
+    # Particles are stored as a structure of arrays: the i-th particle is at (px[i], py[i]), with
+    # heading ptheta[i] and weight pw[i]. Positions and headings are float32 (which is plenty
+    # precise, and halves the memory bandwidth of the sensor model). Weights are always normalized
+    # (the sensor model's log-weights are only exponentiated by normalize_weights).
+    px: np.array = None
+    py: np.array = None
+    ptheta: np.array = None
+    pw: np.array = None
     particles_stamp: rospy.Time
     """ Timestamp of the odometry update that generated the current particles. """
 
     update_count: int = 0
-    is_updating: bool = False
-    last_update: rospy.Time
-    """ Timestamp at which the last update *finished.* """
+
+    odom_queue: queue.Queue
+    """
+    Holds (at most) the most recent odometry message that hasn't been processed yet. The odometry
+    callback just drops messages in here, and the update thread does the actual work.
+    """
+    update_thread: threading.Thread
+    particles_lock: threading.Lock
+    """
+    Held while the particles are being read or replaced (by an update or a new initial pose), so
+    an initial pose set mid-update is never overwritten by that update's result.
+    """
 
     particle_pub: rospy.Publisher
+    particle_markers: MarkerArray
+    """ Preallocated particle cloud, which is updated in place and re-published on every update. """
 
     tf_listener: tf2_ros.TransformListener
     tf_buf: tf2_ros.Buffer
@@ -59,8 +115,8 @@ class ParticleFilter:
     def __init__(self):
         rospy.init_node('pf')
 
-        self.last_update = rospy.Time.now()
         self.particles_stamp = rospy.Time.now()
+        self.recent_poses = np.zeros((3, self.RECENT_POSES_SIZE), dtype=np.float32)
 
         self.tf_buf = tf2_ros.Buffer()
         self.tf_listener = tf2_ros.TransformListener(self.tf_buf)
@@ -70,10 +126,25 @@ class ParticleFilter:
         self.particle_pub = rospy.Publisher("particlecloud",
                                             MarkerArray,
                                             queue_size=10)
+        # NB: Each marker needs its own Pose, because visualize_particles mutates them in place
+        self.particle_markers = MarkerArray(markers=[
+            make_marker(Pose(), shape=Marker.ARROW,
+                        frame_id='map', ns="particle", id=i, lifetime=60)
+            for i in range(self.NUM_PARTICLES)
+        ])
 
         rospy.wait_for_service("static_map")
         get_static_map = rospy.ServiceProxy("static_map", GetMap)
-        self.sensor_model = ParallelRayTracingSensorModel(get_static_map().map)
+        map = get_static_map().map
+        self.sensor_model = self.SENSOR_MODEL_CLASS(map)
+        self.free_space = self.preprocess_free_space(map)
+        self.free_space_resolution = map.info.resolution
+
+        self.particles_lock = threading.Lock()
+        self.odom_queue = queue.Queue(maxsize=1)
+        self.update_thread = threading.Thread(
+            target=self.run_update_loop, daemon=True)
+        self.update_thread.start()
 
         # IMPORTANT: Register subscribers last, so callbacks can't happen before ready
         # pose_listener responds to selection of a new approximate robot
@@ -82,25 +153,71 @@ class ParticleFilter:
                          PoseWithCovarianceStamped,
                          self.on_initial_pose)
 
-        rospy.Subscriber("odom", Odometry, self.on_odom)
+        rospy.Subscriber("odom", Odometry, self.on_odom, queue_size=1)
         rospy.Subscriber("stable_scan", LaserScan, self.on_lidar)
 
     def on_initial_pose(self, msg: PoseWithCovarianceStamped):
-        """ Callback to (re-)initialize the particle filter whenever an initial pose is set. """
+        """
+        Callback to (re-)initialize the particle filter whenever an initial pose is set.
+
+        This waits for any in-progress update to finish, so the new particles always replace that
+        update's particles (and not the other way around).
+        """
 
         x, y, theta = \
             self.tf_helper.convert_pose_to_xy_and_theta(msg.pose.pose)
 
-        particles = self.resample_particles([Particle(x, y, theta, 1)])
+        xs, ys, thetas = self.resample_particles(
+            np.array([x]), np.array([y]), np.array([theta]), np.ones(1)
+        )
+
+        with self.particles_lock:
+            # Forget about the old particles' history
+            self.weight_avg_slow = 0.0
+            self.weight_avg_fast = 0.0
+            self.recent_poses_count = 0
 
-        self.set_particles(msg.header.stamp, particles)
+            # All particles are equally likely (log-weight 0)
+            self.set_particles(msg.header.stamp, xs, ys, thetas, np.zeros(len(xs)))
 
     def on_lidar(self, msg: LaserScan):
         """ Callback whenever new LIDAR data is available. """
         self.last_lidar = msg.ranges
 
     def on_odom(self, msg: Odometry):
-        """ Callback whenever new odometry data is available. """
+        """
+        Callback whenever new odometry data is available.
+
+        Updates are much slower than odometry comes in, so this doesn't do any work itself (which
+        would block other callbacks). Instead, it replaces whatever message is waiting for the update
+        thread with this one, so the update thread always works with the latest odometry.
+        """
+        try:
+            self.odom_queue.put_nowait(msg)
+        except queue.Full:
+            try:
+                self.odom_queue.get_nowait()
+            except queue.Empty:
+                pass  # The update thread grabbed it first
+            self.odom_queue.put_nowait(msg)
+
+    def run_update_loop(self):
+        """ Body of the update thread: process odometry messages as they come in. """
+        while not rospy.is_shutdown():
+            try:
+                msg = self.odom_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            # Don't let one bad update (ie. a tf timeout) kill the thread, and with it localization.
+            # The next odometry message will just try again.
+            try:
+                self.process_odom(msg)
+            except Exception:
+                rospy.logerr("Particle filter update failed:\n" + traceback.format_exc())
+
+    def process_odom(self, msg: Odometry):
+        """ Update the particle filter (if needed) with new odometry data. Runs on the update thread. """
         pose = PoseTuple(
             *self.tf_helper.convert_pose_to_xy_and_theta(msg.pose.pose))
 
@@ -136,102 +253,182 @@ class ParticleFilter:
               and reset it whenever this method returns True.
 
         Steps:
-        1. Resample particles
+        1. Resample particles (replacing some with recovery particles if needed)
         2. Apply motion model
         3. Re-weight based on sensor model
 
-        Calling this method may or may not trigger an update (depending on: if an update is already
-        in progress, if the initial pose/particles haven't been set yet, and if this odometry data
-        is out of date). Returns True if an update actually happened, or false otherwise.
-        """
-        # Ignore any updates that happened while we were working on the last update (allows queue to drain)
-        if stamp < self.last_update:
-            return False
-
-        # Require previous particles (initialized by initial pose)
-        if self.particles is None:
-            return False
+        Calling this method may or may not trigger an update (depending on if the initial
+        pose/particles and LIDAR data have been set yet). Returns True if an update actually happened,
+        or false otherwise.
 
+        This should only be called from the update thread, so updates never overlap. It holds
+        particles_lock for the whole update, so it can't race with on_initial_pose.
+        """
         # Make sure we have some LIDAR data
         if self.last_lidar is None:
             return False
 
-        # We don't do multiple updates in parallel
-        if self.is_updating:
-            return False
+        with self.particles_lock:
+            # Require previous particles (initialized by initial pose)
+            if self.px is None:
+                return False
 
-        self.is_updating = True
-        try:
             with print_time('Update'):
                 # Use a consistent LIDAR scan for the entire update
                 self.sensor_model.set_lidar(self.last_lidar)
 
                 # Resample Particles
-                particles = self.resample_particles(self.particles)
+                xs, ys, thetas = self.resample_particles(
+                    self.px, self.py, self.ptheta, self.pw)
+                xs, ys, thetas = self.add_recovery_particles(xs, ys, thetas)
 
                 # Apply Motion Model
-                # NOTE: Doing this in parallel has a small performance benefit, but it's not worth the complexity
-                particles = [
-                    self.motion_model.apply(p, delta_pose)
-                    for p in particles
-                ]
+                xs, ys, thetas = self.motion_model.apply(
+                    xs, ys, thetas, delta_pose)
 
                 # Apply Sensor Model
-                particles = self.sensor_model.weight_particles(particles)
+                log_weights = self.sensor_model.weight_particles(xs, ys, thetas)
+                self.update_weight_averages(log_weights)
 
                 # Set Particles
-                self.set_particles(stamp, particles)
-                self.last_update = rospy.Time.now()
-        finally:
-            self.is_updating = False
+                self.set_particles(stamp, xs, ys, thetas, log_weights)
 
         return True
 
-    def resample_particles(self, particles: List[Particle], k: int = None) -> List[Particle]:
+    def resample_particles(self, xs: np.array, ys: np.array, thetas: np.array, weights: np.array,
+                           k: int = None) -> Tuple[np.array, np.array, np.array]:
         """
-        Resample particles using a weighted random sample.
+        Resample particles using systematic resampling (see systematic_resample). Unlike the rest of
+        the filter, this takes regular (not log) weights, like self.pw.
 
-        All returned particles have an equal weight (1). `k` particles are returned, which defaults
-        to self.NUM_PARTICLES.
+        Returns the x, y, and theta arrays of the new particles, which all have an equal weight.
+        `k` particles are returned, which defaults to self.NUM_PARTICLES.
 
-        This is a pure method (doesn't mutate anything, returns new particles).
+        This is a pure method (doesn't mutate anything, returns new arrays).
         """
 
         if k is None:
             k = self.NUM_PARTICLES
 
-        choices = random.choices(
-            particles,
-            weights=[p.weight for p in particles],
-            k=k
+        choices = systematic_resample(weights, k)
+
+        # Draw all the noise for x, y, and theta at once
+        x_noise, y_noise, theta_noise = rng.standard_normal((3, k))
+
+        return (
+            self.particle_sampler_xy.sample(
+                xs[choices], standard_normals=x_noise).astype(np.float32),
+            self.particle_sampler_xy.sample(
+                ys[choices], standard_normals=y_noise).astype(np.float32),
+            normalize_angle(self.particle_sampler_theta.sample(
+                thetas[choices], standard_normals=theta_noise)).astype(np.float32)
         )
 
-        return [
-            Particle(
-                x=self.particle_sampler_xy.sample(choice.x),
-                y=self.particle_sampler_xy.sample(choice.y),
-                theta=self.particle_sampler_theta.sample(choice.theta),
-                weight=1
-            )
-            for choice in choices
-        ]
-
-    def set_particles(self, stamp: rospy.Time, particles: List[Particle]):
-        """ Save a new set of particles, including updating the computed reference frame. """
-        self.particles = self.normalize_weights(particles)
+    def add_recovery_particles(self, xs: np.array, ys: np.array, thetas: np.array
+                               ) -> Tuple[np.array, np.array, np.array]:
+        """
+        Replace some randomly chosen particles with recovery particles (augmented MCL). The fraction
+        replaced is max(0, 1 - weight_avg_fast / weight_avg_slow), so this does nothing unless the
+        average particle weight has recently dropped.
+
+        RECOVERY_MAP_FRACTION of the recovery particles are sampled uniformly from the map's free
+        space, and the rest are sampled around random recent pose estimates.
+
+        This is a pure method (doesn't mutate anything, returns new arrays).
+        """
+        if self.weight_avg_slow <= 0.0:
+            return xs, ys, thetas
+
+        num_recovery = int(
+            len(xs) * max(0.0, 1.0 - (self.weight_avg_fast / self.weight_avg_slow)))
+        if num_recovery == 0:
+            return xs, ys, thetas
+
+        num_from_map = num_recovery
+        if self.recent_poses_count > 0:
+            num_from_map = int(round(num_recovery * self.RECOVERY_MAP_FRACTION))
+        num_from_poses = num_recovery - num_from_map
+
+        # Sample around random recent pose estimates
+        choices = rng.integers(
+            min(self.recent_poses_count, self.RECENT_POSES_SIZE), size=num_from_poses) \
+            if num_from_poses > 0 else np.zeros(0, dtype=np.intp)
+        recent_xs, recent_ys, recent_thetas = self.recent_poses[:, choices]
+        pose_xs = self.recovery_sampler_xy.sample(recent_xs)
+        pose_ys = self.recovery_sampler_xy.sample(recent_ys)
+        pose_thetas = self.recovery_sampler_theta.sample(recent_thetas)
+
+        # Sample uniformly from the map's free space (anywhere within a random free cell)
+        map_xs, map_ys = self.free_space[:, rng.integers(
+            self.free_space.shape[1], size=num_from_map)]
+        half_cell = self.free_space_resolution / 2
+        map_xs = map_xs + rng.uniform(-half_cell, half_cell, num_from_map)
+        map_ys = map_ys + rng.uniform(-half_cell, half_cell, num_from_map)
+        map_thetas = rng.uniform(-math.pi, math.pi, num_from_map)
+
+        # Replace random particles: resampled particles are sorted by parent, so replacing a fixed
+        # range would always replace the same parents' copies (ie. good recovery particles from the
+        # previous update).
+        replaced = rng.choice(len(xs), num_recovery, replace=False)
+
+        xs, ys, thetas = xs.copy(), ys.copy(), thetas.copy()
+        xs[replaced] = np.concatenate((pose_xs, map_xs))
+        ys[replaced] = np.concatenate((pose_ys, map_ys))
+        thetas[replaced] = normalize_angle(
+            np.concatenate((pose_thetas, map_thetas)))
+
+        return xs, ys, thetas
+
+    def update_weight_averages(self, log_weights: np.array):
+        """
+        Update the moving averages of the average particle weight used by add_recovery_particles.
+
+        The average weight itself is far too small to represent (see SensorModel.weight_particles),
+        so this uses the average weight's geometric mean over the LIDAR readings the sensor model
+        used instead, which is comparable between updates (even if some readings were invalid).
+        """
+        num_readings = np.count_nonzero(self.sensor_model.valid_readings())
+        if num_readings == 0:
+            return  # No information about how well the particles fit
+
+        log_weight_avg = logsumexp(log_weights) - math.log(len(log_weights))
+        weight_avg = math.exp(log_weight_avg / num_readings)
+        self.weight_avg_slow += self.RECOVERY_ALPHA_SLOW * \
+            (weight_avg - self.weight_avg_slow)
+        self.weight_avg_fast += self.RECOVERY_ALPHA_FAST * \
+            (weight_avg - self.weight_avg_fast)
+
+    def set_particles(self, stamp: rospy.Time, xs: np.array, ys: np.array, thetas: np.array,
+                      log_weights: np.array):
+        """
+        Save a new set of particles (with unnormalized log-weights), including updating the computed
+        reference frame.
+        """
+        self.px = xs
+        self.py = ys
+        self.ptheta = thetas
+        self.pw = self.normalize_weights(log_weights)
         self.particles_stamp = stamp
 
         # NB: Particles are always in the map reference frame
-        robot_pose = np.average([
-            (particle.x, particle.y, particle.theta)
-            for particle in self.particles
-        ], axis=0, weights=[p.weight for p in self.particles])
+        # The weights are normalized, so each weighted average is just a dot product. Headings are
+        # averaged as unit vectors, so that they wrap around correctly at +/- pi.
+        robot_pose = np.array([
+            self.px @ self.pw,
+            self.py @ self.pw,
+            math.atan2(np.sin(self.ptheta) @ self.pw,
+                       np.cos(self.ptheta) @ self.pw)
+        ])
 
         # TF explodes if it ever sees a NaN
         if np.isnan(robot_pose).any():
             print("WARNING: Robot pose is NaN!", robot_pose)
             return
 
+        # Remember this estimate, in case we need recovery particles later
+        self.recent_poses[:, self.recent_poses_count % self.RECENT_POSES_SIZE] = robot_pose
+        self.recent_poses_count += 1
+
         self.tf_helper.fix_map_to_odom_transform(
             stamp,
             self.tf_helper.convert_xy_and_theta_to_pose(robot_pose)
@@ -242,48 +439,84 @@ class ParticleFilter:
     def visualize_particles(self):
         """ Publish particles for viewing in RViz. """
         # Publish particles
-        markers = MarkerArray()
-        for i, particle in enumerate(self.normalize_weights(self.particles)):
-            pose = self.tf_helper.convert_xy_and_theta_to_pose(
-                (particle.x, particle.y, particle.theta)
-            )
-
-            # Heuristic to produce decently-sized particle arrows
-            scale_factor = max(
-                0 if np.isnan(particle.weight) else (
-                    particle.weight * (self.NUM_PARTICLES / 3)),
-                0.1)
-
-            scale = (scale_factor, scale_factor * 0.1, scale_factor * 0.1)
-
-            marker = make_marker(pose, shape=Marker.ARROW,
-                                 frame_id='map', ns="particle", id=i, lifetime=60, scale=scale)
-
-            markers.markers.append(marker)
-
-        self.particle_pub.publish(markers)
+        # The markers are preallocated, so just overwrite their poses and scales in place. Headings
+        # are a pure yaw, so the quaternion is just (0, 0, sin(theta / 2), cos(theta / 2)).
+        stamp = rospy.Time.now()
+
+        # Heuristic to produce decently-sized particle arrows
+        # NB: self.pw is already normalized (by set_particles)
+        scale_factors = np.maximum(
+            np.nan_to_num(self.pw * (self.NUM_PARTICLES / 3), nan=0.0),
+            0.1)
+
+        # Do all the math (and conversion to Python floats) up front, so the loop only assigns fields
+        for marker, x, y, qz, qw, scale_factor in zip(
+                self.particle_markers.markers,
+                self.px.tolist(),
+                self.py.tolist(),
+                np.sin(self.ptheta / 2).tolist(),
+                np.cos(self.ptheta / 2).tolist(),
+                scale_factors.tolist()):
+            marker.header.stamp = stamp
+            marker.pose.position.x = x
+            marker.pose.position.y = y
+            marker.pose.orientation.z = qz
+            marker.pose.orientation.w = qw
+            marker.scale.x = scale_factor
+            marker.scale.y = scale_factor * 0.1
+            marker.scale.z = scale_factor * 0.1
+
+        self.particle_pub.publish(self.particle_markers)
 
         # Save some images of sensor model internal state
         # To enable or disable this, change DEBUG_SAVE_SENSOR_STATE_PLOTS to a number (15 is good),
         # or 0 (to disable).
         if not isinstance(self.sensor_model, ParallelRayTracingSensorModel):
-            for particle in random.choices(self.particles, k=self.DEBUG_SAVE_SENSOR_STATE_PLOTS):
-                self.sensor_model.calculate_weight(particle)
+            for i in rng.choice(len(self.pw), size=self.DEBUG_SAVE_SENSOR_STATE_PLOTS):
+                self.sensor_model.calculate_weight(
+                    Particle(self.px[i], self.py[i], self.ptheta[i], self.pw[i]))
                 self.sensor_model.save_debug_plot(
                     f"particle_{self.update_count:03d}")
         self.update_count += 1
 
-    def normalize_weights(self, particles: List[Particle]) -> List[Particle]:
+    def normalize_weights(self, log_weights: np.array) -> np.array:
+        """
+        Convert unnormalized log-weights to normalized weights (so they all add to 1).
+
+        Subtracting the log of the total before exponentiating keeps this from underflowing, no
+        matter how small the weights are.
+
+        If the total isn't finite (ie. every particle has a log-weight of -inf), there's no way to
+        tell the particles apart, so they're all given equal weights.
+
+        This is a pure method (doesn't mutate anything, returns a new array).
+        """
+        log_total = logsumexp(log_weights)
+        if not np.isfinite(log_total):
+            return np.full(len(log_weights), 1.0 / len(log_weights))
+        return np.exp(log_weights - log_total)
+
+    @staticmethod
+    def preprocess_free_space(map: OccupancyGrid) -> np.array:
         """
-        Normalize the weights of the particles (so they all add to 1).
+        Find the coordinates of the center of every free cell of a map (see free_space). Only do
+        this once per map.
 
-        This is a pure method (doesn't mutate anything, returns new particles).
+        Like RayTracingSensorModel.preprocess_map (and OccupancyField), the i-th cell is centered
+        at origin + (i * resolution). Cells are 0 if they're free and -1 if unknown.
         """
-        total = sum(p.weight for p in particles)
-        return [
-            Particle(p.x, p.y, p.theta, p.weight / total)
-            for p in particles
-        ]
+        if map.info.origin.orientation.w != 1.0:
+            raise ValueError("Unsupported map with rotated origin.")
+
+        # Occupancy grids are stored in row major order, so each row of the grid is one y value
+        grid = np.asarray(map.data, dtype=np.int8).reshape(
+            (map.info.height, map.info.width))
+        ys, xs = np.nonzero(grid == 0)
+
+        return np.vstack((
+            (xs * map.info.resolution) + map.info.origin.position.x,
+            (ys * map.info.resolution) + map.info.origin.position.y
+        )).astype(np.float32)
 
     def run(self):
         r = rospy.Rate(5)
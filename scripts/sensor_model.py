@@ -1,34 +1,66 @@
+import os
 import math
 import rospy
 import numpy as np
 import matplotlib.pyplot as plt
 
 from pathlib import Path
+from numba import njit, prange
+from scipy.spatial import cKDTree
 from threading import Lock
 from abc import ABC, abstractmethod
-from typing import List, Optional, Iterable
+from typing import Optional
 from concurrent.futures import Executor, ProcessPoolExecutor
 
 from nav_msgs.msg import OccupancyGrid
+from occupancy_field import OccupancyField
 from helper_functions import Particle, normalize_angle
 
 
 class SensorModel(ABC):
     """ Base class for sensor models. """
 
+    RAY_STEP: int = 10
+    """
+    Only use every RAY_STEP-th LIDAR reading (ie. one ray every RAY_STEP degrees). The likelihood is
+    dominated by a few good readings, so a few dozen rays is plenty for a particle filter.
+    """
+
     last_lidar: Optional[np.array] = None
-    """ Most recent LIDAR data. """
+    """ Most recent LIDAR data, as a float32 array (converted once per scan). """
 
     def set_lidar(self, ranges: list):
         """ Notify the model of new LIDAR data. """
-        self.last_lidar = np.array(ranges[0:360])
+        self.last_lidar = np.array(ranges[0:360], dtype=np.float32)
+
+    @property
+    def ray_indices(self) -> np.array:
+        """ Indices into last_lidar (ie. angles, in degrees) of the LIDAR readings to use. """
+        return np.arange(0, 360, self.RAY_STEP)
+
+    def valid_readings(self) -> np.array:
+        """
+        Mask (the same size as ray_indices) of the readings in last_lidar the model actually uses.
+
+        Non-finite readings (the LIDAR sometimes returns inf when it doesn't see anything) are always
+        skipped, since they would make every particle's log-weight -inf.
+        """
+        return np.isfinite(self.last_lidar[self.ray_indices])
 
     @abstractmethod
-    def weight_particles(self, particles: Iterable[Particle]) -> List[Particle]:
+    def weight_particles(self, xs: np.array, ys: np.array, thetas: np.array) -> np.array:
+        """
+        Weight a set of particles using the sensor model. Particles are passed as three (P,)-sized
+        arrays, and a (P,)-sized array of (unnormalized) log-weights is returned.
+
+        Weights are in log-space because likelihoods over dozens of LIDAR readings span far more
+        orders of magnitude than a float can represent.
+        """
         pass
 
     @abstractmethod
     def calculate_weight(self, particle: Particle) -> float:
+        """ Calculate the (unnormalized) log-weight of a single particle. """
         pass
 
     @abstractmethod
@@ -40,7 +72,8 @@ class RayTracingSensorModel(SensorModel):
     """
     A sensor model based on ray tracing.
 
-    Also consider ParallelRayTracingSensorModel, which is much faster because it uses multiple cores.
+    Also consider NumbaRayTracingSensorModel or ParallelRayTracingSensorModel, which are much faster
+    because they use multiple cores.
     """
 
     MAX_DISTANCE: float = 3.0
@@ -49,9 +82,22 @@ class RayTracingSensorModel(SensorModel):
     and would return 0).
     """
 
+    SIGMA: float = 0.2
+    """ Standard deviation (in meters) of the difference between actual and expected LIDAR readings. """
+
     map_obstacles: np.array = None
     """ (n, 2)-sized matrix of x, y coordinates of occupied squares (ie. obstacles) on the map. """
 
+    obstacles_x: np.array = None
+    obstacles_y: np.array = None
+    """
+    Contiguous copies of the columns of map_obstacles. The map never changes, so these are split out
+    once up front instead of slicing (and striding through) map_obstacles on every update.
+    """
+
+    obstacle_tree: cKDTree
+    """ KD-tree of map_obstacles, used to quickly find the obstacles near the particles. """
+
     debug_data_dir: Path
     """ Folder to store debugging images (see save_debug_plot). Defaults to __file__/../particle_sensor_data. """
 
@@ -64,16 +110,99 @@ class RayTracingSensorModel(SensorModel):
 
     def __init__(self, map: OccupancyGrid, debug_data_dir: Path = Path(__file__).parent.parent / 'particle_sensor_data'):
         self.map_obstacles = self.preprocess_map(map)
+        self.obstacles_x = np.ascontiguousarray(self.map_obstacles[:, 0])
+        self.obstacles_y = np.ascontiguousarray(self.map_obstacles[:, 1])
+        self.obstacle_tree = cKDTree(self.map_obstacles)
 
         self.debug_data_dir = debug_data_dir
         self.debug_data_dir.mkdir(exist_ok=True)
 
-    def weight_particles(self, particles: Iterable[Particle]) -> List[Particle]:
-        """ Re-weight a set of particles using the sensor model. Does not mutate its input. """
-        return [
-            Particle(p.x, p.y, p.theta, self.calculate_weight(p))
-            for p in particles
-        ]
+    def weight_particles(self, xs: np.array, ys: np.array, thetas: np.array) -> np.array:
+        """
+        Batched version of calculate_weight, which weights every particle at once.
+
+        The algorithm is identical to calculate_weight, but all the work happens in a handful of
+        NumPy operations on (P, M)-sized matrices (where M is the number of obstacles near the
+        particles, see nearby_obstacles) instead of in a Python loop. This does not store any debug
+        data.
+        """
+        num_particles = len(xs)
+        nearby = self.nearby_obstacles(xs, ys)
+
+        # Shift the map to be centered at each particle: row i is the map relative to particle i
+        obstacles_dx = self.obstacles_x[nearby] - xs[:, np.newaxis]
+        obstacles_dy = self.obstacles_y[nearby] - ys[:, np.newaxis]
+
+        # Convert to polar coordinates, ignoring any obstacles too far away
+        obstacle_rs = np.hypot(obstacles_dx, obstacles_dy)
+        particle_idxs, obstacle_idxs = np.nonzero(obstacle_rs < self.MAX_DISTANCE)
+        obstacle_rs = obstacle_rs[particle_idxs, obstacle_idxs]
+
+        # Rotate by each particle's heading, then descretize to whole-degree increments in [0, 360)
+        obstacle_thetas = np.mod(
+            np.rad2deg(
+                np.arctan2(
+                    obstacles_dy[particle_idxs, obstacle_idxs],
+                    obstacles_dx[particle_idxs, obstacle_idxs]
+                ) - thetas[particle_idxs]
+            ).round(),
+            360
+        ).astype(np.intp)
+
+        # Only keep obstacles on one of the rays we care about
+        on_ray = obstacle_thetas % self.RAY_STEP == 0
+        particle_idxs = particle_idxs[on_ray]
+        obstacle_rs = obstacle_rs[on_ray]
+        ray_idxs = obstacle_thetas[on_ray] // self.RAY_STEP
+
+        # Find the closest obstacle on each ray, for every particle
+        # Each obstacle gets a key of (particle, ray), flattened into an index into lidar_expected.
+        # Sorting by key puts every obstacle in a bin next to each other, so the minimum of each bin
+        # is a single (contiguous, branchless) np.minimum.reduceat.
+        ray_indices = self.ray_indices
+        keys = particle_idxs * len(ray_indices) + ray_idxs
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        bin_starts = np.flatnonzero(
+            np.diff(sorted_keys, prepend=-1) != 0)
+        bins = sorted_keys[bin_starts]
+
+        lidar_expected = np.full(
+            (num_particles, len(ray_indices)), np.inf, dtype=np.float32)
+        if len(bins) > 0:
+            lidar_expected.flat[bins] = np.minimum.reduceat(
+                obstacle_rs[order], bin_starts)
+
+        # Account for LIDAR's max range (this also catches angles without any obstacles)
+        lidar_expected[lidar_expected > self.MAX_DISTANCE] = 0.0
+
+        # Compare to LIDAR data (skipping invalid readings)
+        valid = self.valid_readings()
+        lidar_diff = np.abs(
+            self.last_lidar[ray_indices][valid] - lidar_expected[:, valid])
+
+        # Calculate log-weights (see calculate_weight)
+        return -0.5 * np.sum(lidar_diff ** 2, axis=1) / (self.SIGMA ** 2)
+
+    def nearby_obstacles(self, xs: np.array, ys: np.array) -> np.array:
+        """
+        Find the indices of every obstacle that might be within MAX_DISTANCE of one of the particles
+        (ie. all the obstacles the LIDAR could possibly see).
+
+        Particles are usually clustered together, so this is typically a small fraction of the map.
+        To keep it cheap, this does a single KD-tree query for a circle around the whole particle
+        cloud, so it may include some extra obstacles (which ray tracing ignores anyways).
+        """
+        if len(xs) == 0:
+            return np.zeros(0, dtype=np.intp)
+
+        center_x, center_y = np.mean(xs), np.mean(ys)
+        cloud_radius = np.max(np.hypot(xs - center_x, ys - center_y))
+        return np.asarray(
+            self.obstacle_tree.query_ball_point(
+                (center_x, center_y), r=cloud_radius + self.MAX_DISTANCE),
+            dtype=np.intp
+        )
 
     def calculate_weight(self, particle: Particle) -> float:
         """
@@ -89,69 +218,47 @@ class RayTracingSensorModel(SensorModel):
         """
         # Take map data as cartesian coords, and shift to center at particle
         # NB: Both the map and all particles are in the `map` frame
-        obstacles_shifted = self.map_obstacles - \
-            [particle.x, particle.y]
+        obstacles_dx = self.obstacles_x - particle.x
+        obstacles_dy = self.obstacles_y - particle.y
 
         # Convert to polar coordinates
-        obstacle_rs = np.linalg.norm(obstacles_shifted, axis=1)
+        obstacle_rs = np.hypot(obstacles_dx, obstacles_dy)
         mask = obstacle_rs < self.MAX_DISTANCE  # ignore any obstacles too far away
-        obstacle_rs = np.concatenate((
-            obstacle_rs[mask],
-            # Add some an obstacle very far away for all possible angles, so there's something at
-            # every angle.
-            np.full(360, 10.0)
-        ))
+        obstacle_rs = obstacle_rs[mask]
 
         # Calculate the angle of each obstacle, rotating by the particle's heading
         obstacle_thetas_rad = normalize_angle(
             np.arctan2(
-                obstacles_shifted[mask][:, 1],
-                obstacles_shifted[mask][:, 0]
+                obstacles_dy[mask],
+                obstacles_dx[mask]
             ) - particle.theta  # Rotate by particle's heading
         )
 
         # Convert to degrees, and descretize to whole-degree increments (like LIDAR data)
         # This is the only place we use degrees, but it's helpful since LIDAR is indexed by degree
-        obstacle_thetas = np.concatenate((
-            np.rad2deg(obstacle_thetas_rad).round(),
-            # Make sure there's something for every angle here too
-            np.arange(360)
-        ))
-
-        # We've normalized angels to [-180, 180], so shift to [0, 360]
-        obstacle_thetas[obstacle_thetas < 0.0] += 360.0
-
-        # Find the closest obstacle at each angle
-        # This grouping logic is from: https://stackoverflow.com/a/43094244
-        order = obstacle_thetas.argsort()  # returns indexes in order by sorted value
-        # NOTE: obstacles_by_angle is a *normal list* of arrays, where the array at index i is the
-        # (expected) LIDAR distance values at angle i.
-        splits = np.unique(obstacle_thetas[order], return_index=True)[1][1:]
-        obstacles_by_angle = np.split(obstacle_rs[order], splits)
+        # We've normalized angels to [-180, 180], so shift to [0, 360)
+        obstacle_thetas = np.mod(np.rad2deg(obstacle_thetas_rad).round(), 360)
 
         # Find the nearest obstacle at each angle
-        lidar_expected = np.array([
-            np.minimum.reduce(
-                a,
-                initial=10.0,
-                axis=0
-            ) for a in obstacles_by_angle  # can't figure out how to replace this loop with numpy magic
-        ])
+        # np.minimum.at is unbuffered, so repeated angles are all taken into account. Angles without
+        # any obstacles are left at infinity (ie. nothing there).
+        lidar_expected = np.full(360, np.inf, dtype=np.float32)
+        np.minimum.at(
+            lidar_expected,
+            obstacle_thetas.astype(np.intp),
+            obstacle_rs
+        )
 
         # Account for LIDAR's max range
         lidar_expected[lidar_expected > self.MAX_DISTANCE] = 0.0
 
-        # Compare to LIDAR data
-        lidar_diff = np.abs(self.last_lidar - lidar_expected)
+        # Compare to LIDAR data (only on the rays we care about, skipping invalid readings)
+        ray_indices = self.ray_indices[self.valid_readings()]
+        lidar_diff = np.abs(
+            self.last_lidar[ray_indices] - lidar_expected[ray_indices])
 
-        # Calculate weight
-        weight = np.sum(
-            (
-                0.5 * (
-                    np.exp(-(lidar_diff[lidar_diff > 0.0] ** 2) / 0.01)
-                )
-            ) ** 3
-        )
+        # Calculate the log-weight: each reading is assumed to have independent Gaussian error
+        weight = -0.5 * np.sum(lidar_diff ** 2) / (self.SIGMA ** 2)
 
         # Save data for generating debug plots
         self.weight = weight
@@ -180,7 +287,7 @@ class RayTracingSensorModel(SensorModel):
                 self.last_lidar, 'r.', label="LIDAR (Actual)")
         ax.set_rmax(3)
         ax.set_title(
-            f"Sensor Model (x: {self.particle.x:.2f}, y: {self.particle.y:.2f}, h: {self.particle.theta:.2f}, w: {self.weight:.6f})"
+            f"Sensor Model (x: {self.particle.x:.2f}, y: {self.particle.y:.2f}, h: {self.particle.theta:.2f}, log w: {self.weight:.2f})"
         )
         ax.legend()
         fig.savefig(self.debug_data_dir / f"{name}_{self.weight:.3f}.png")
@@ -201,28 +308,166 @@ class RayTracingSensorModel(SensorModel):
         if map.info.origin.orientation.w != 1.0:
             raise ValueError("Unsupported map with rotated origin.")
 
-        # Number of obstacle points to deal with
-        total_occupied = np.sum(np.array(map.data) > 0)
+        # Occupancy grids are stored in row major order, so each row of the grid is one y value
+        grid = np.asarray(map.data, dtype=np.int8).reshape(
+            (map.info.height, map.info.width))
+        ys, xs = np.nonzero(grid > 0)
 
         # The coordinates of each occupied grid cell in the map
-        occupied = np.zeros((total_occupied, 2))
-
-        curr = 0
-        for x in range(map.info.width):
-            for y in range(map.info.height):
-                # Occupancy grids are stored in row major order
-                ind = x + (y * map.info.width)
-                if map.data[ind] > 0:
-                    occupied[curr, 0] = (float(x) * map.info.resolution) \
-                        + map.info.origin.position.x
-                    occupied[curr, 1] = (float(y) * map.info.resolution) \
-                        + map.info.origin.position.y
-                    curr += 1
+        # float32 is plenty precise for map coordinates, and halves the memory bandwidth of ray tracing
+        occupied = np.column_stack((
+            (xs * map.info.resolution) + map.info.origin.position.x,
+            (ys * map.info.resolution) + map.info.origin.position.y
+        )).astype(np.float32)
 
         print("Num Map Obstacles:", len(occupied), '!\n\n')
 
         return occupied
 
+
+class LikelihoodFieldSensorModel(SensorModel):
+    """
+    A sensor model based on a likelihood field.
+
+    Instead of ray tracing, each LIDAR reading is projected into the map from the particle's pose,
+    and scored by how close the point it would have hit is to an obstacle (looked up in an
+    OccupancyField). This is O(P * 360 / RAY_STEP), regardless of the size of the map.
+    """
+
+    SIGMA: float = 0.1
+    """ Standard deviation (in meters) of the distance between a projected LIDAR point and an obstacle. """
+
+    OFF_MAP_DISTANCE: float = 3.0
+    """ Distance to the closest obstacle assumed for LIDAR points which land outside the map. """
+
+    occupancy_field: OccupancyField
+
+    lidar_angles: np.array = np.deg2rad(np.arange(360)).astype(np.float32)
+    """ Angle (relative to the robot's heading) of each LIDAR reading. """
+
+    def __init__(self, map: OccupancyGrid):
+        self.occupancy_field = OccupancyField(map)
+
+    def valid_readings(self) -> np.array:
+        # The LIDAR returns 0 (or sometimes inf) when it doesn't see anything, so skip those readings
+        return super().valid_readings() & (self.last_lidar[self.ray_indices] > 0.0)
+
+    def weight_particles(self, xs: np.array, ys: np.array, thetas: np.array) -> np.array:
+        lidar = self.last_lidar[self.ray_indices]
+        lidar_angles = self.lidar_angles[self.ray_indices]
+
+        valid = self.valid_readings()
+        ranges = lidar[valid]
+
+        # Project each reading into the map from each particle: (P, number of valid readings)
+        angles = thetas[:, np.newaxis] + lidar_angles[valid]
+        hit_xs = xs[:, np.newaxis] + ranges * np.cos(angles)
+        hit_ys = ys[:, np.newaxis] + ranges * np.sin(angles)
+
+        distances = self.occupancy_field.get_closest_obstacle_distance(
+            hit_xs, hit_ys)
+        distances[np.isnan(distances)] = self.OFF_MAP_DISTANCE
+
+        # Each reading is assumed to have independent Gaussian error, so this is the log-likelihood
+        return -0.5 * np.sum(distances ** 2, axis=1) / (self.SIGMA ** 2)
+
+    def calculate_weight(self, particle: Particle) -> float:
+        return self.weight_particles(
+            np.array([particle.x]), np.array([particle.y]), np.array([particle.theta])
+        )[0]
+
+    _has_done_debug_plot_warning = False
+
+    def save_debug_plot(self, name: str):
+        if not self._has_done_debug_plot_warning:
+            print("WARNING: debug plots aren't supported for the likelihood field sensor model")
+            self._has_done_debug_plot_warning = True
+
+##
+# Numba-compiled raytracing.
+##
+
+
+# NB: There's intentionally no explicit signature, which would compile the kernel (and start
+# Numba's threading layer) as soon as this module is imported, even if the kernel is never used.
+@njit(parallel=True, fastmath=True, cache=True)
+def _ray_trace_kernel(xs, ys, thetas, obstacles_x, obstacles_y, lidar, max_distance, ray_step,
+                      sigma):
+    """
+    Compiled equivalent of RayTracingSensorModel.weight_particles. Particles are ray traced in
+    parallel, and each particle is done in a single pass over the obstacles, so none of the
+    (P, M)-sized intermediate matrices are ever allocated.
+
+    NB: fastmath assumes there are no infinities, so max_distance (not np.inf) marks angles without
+    any obstacles, and invalid LIDAR readings must be replaced with a negative value (which are
+    skipped) before calling this.
+    """
+    num_particles = xs.shape[0]
+    num_obstacles = obstacles_x.shape[0]
+    log_weights = np.zeros(num_particles)
+
+    for p in prange(num_particles):
+        # Find the closest obstacle at each angle
+        lidar_expected = np.full(360, max_distance, dtype=np.float32)
+        for m in range(num_obstacles):
+            dx = obstacles_x[m] - xs[p]
+            dy = obstacles_y[m] - ys[p]
+            r = math.sqrt(dx * dx + dy * dy)
+            if r >= max_distance:
+                continue
+
+            angle = int(round(math.degrees(math.atan2(dy, dx) - thetas[p]))) % 360
+            if angle % ray_step != 0:
+                continue
+            if r < lidar_expected[angle]:
+                lidar_expected[angle] = r
+
+        # Compare to LIDAR data and calculate log-weight (see RayTracingSensorModel.calculate_weight)
+        squared_error = 0.0
+        for angle in range(0, 360, ray_step):
+            if lidar[angle] < 0.0:
+                continue  # Invalid reading
+            expected = lidar_expected[angle]
+            if expected >= max_distance:
+                expected = 0.0
+            diff = lidar[angle] - expected
+            squared_error += diff * diff
+        log_weights[p] = -0.5 * squared_error / (sigma * sigma)
+
+    return log_weights
+
+
+class NumbaRayTracingSensorModel(RayTracingSensorModel):
+    """
+    Version of RayTracingSensorModel that ray-traces with a JIT-compiled (Numba) kernel, which runs
+    on multiple cores.
+
+    This is the fastest ray tracing sensor model, and it supports debug plots (calculate_weight is
+    inherited from RayTracingSensorModel). The kernel is compiled (and cached on disk) the first
+    time it's used, so the first update after changing it is slow.
+    """
+
+    def weight_particles(self, xs: np.array, ys: np.array, thetas: np.array) -> np.array:
+        nearby = self.nearby_obstacles(xs, ys)
+
+        # Mark invalid readings for the kernel (see _ray_trace_kernel)
+        ray_indices = self.ray_indices[self.valid_readings()]
+        lidar = np.full(360, -1.0, dtype=np.float32)
+        lidar[ray_indices] = self.last_lidar[ray_indices]
+
+        # Always pass float32, so the kernel is only ever compiled once (these are no-ops if the
+        # particles already are)
+        return _ray_trace_kernel(
+            xs.astype(np.float32, copy=False),
+            ys.astype(np.float32, copy=False),
+            thetas.astype(np.float32, copy=False),
+            self.obstacles_x[nearby], self.obstacles_y[nearby],
+            lidar,
+            self.MAX_DISTANCE,
+            self.RAY_STEP,
+            self.SIGMA
+        )
+
 ##
 # Helpers for multi-process raytracing.
 ##
@@ -243,14 +488,14 @@ def _setup_worker_process(map):
         _worker_ray_tracer = RayTracingSensorModel(map)
 
 
-def _ray_trace_particle(data):
+def _ray_trace_particles(data):
     with _lock:
         if _worker_ray_tracer is None:
             raise ValueError("Worker process hasn't been setup!")
 
-        p, lidar = data
+        xs, ys, thetas, lidar = data
         _worker_ray_tracer.set_lidar(lidar)
-        return Particle(p.x, p.y, p.theta, _worker_ray_tracer.calculate_weight(p))
+        return _worker_ray_tracer.weight_particles(xs, ys, thetas)
 
 
 class ParallelRayTracingSensorModel(SensorModel):
@@ -263,9 +508,13 @@ class ParallelRayTracingSensorModel(SensorModel):
     """
 
     executor: Executor
+    num_workers: int
 
     def __init__(self, map: OccupancyGrid):
+        # This is the same default that ProcessPoolExecutor uses
+        self.num_workers = os.cpu_count() or 1
         self.executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
             initializer=_setup_worker_process,
             initargs=(map,)
         )
@@ -273,13 +522,20 @@ class ParallelRayTracingSensorModel(SensorModel):
     def __del__(self):
         self.executor.shutdown()
 
-    def weight_particles(self, particles: Iterable[Particle]) -> List[Particle]:
-        # XXX: It's inefficient to pass the LIDAR data through once for each particle,
-        # but there isn't a good way with the Executor API to provide contextual data.
-        return list(self.executor.map(
-            _ray_trace_particle,
-            ((p, self.last_lidar) for p in particles)
-        ))
+    def weight_particles(self, xs: np.array, ys: np.array, thetas: np.array) -> np.array:
+        # Each worker ray-traces one batch of particles at once, so split the particles into one
+        # chunk per worker (but never into empty chunks, if there are more workers than particles)
+        num_chunks = max(min(self.num_workers, len(xs)), 1)
+        chunks = zip(
+            np.array_split(xs, num_chunks),
+            np.array_split(ys, num_chunks),
+            np.array_split(thetas, num_chunks)
+        )
+
+        return np.concatenate(list(self.executor.map(
+            _ray_trace_particles,
+            ((*chunk, self.last_lidar) for chunk in chunks)
+        )))
 
     def calculate_weight(self, particle: Particle) -> float:
         raise NotImplementedError(